@@ -1,104 +1,341 @@
 import streamlit as st
 from google import genai
-from PIL import Image, ImageEnhance
+from google.genai import types
+import cv2
+import numpy as np
 import sqlite3
 import pandas as pd
 from datetime import datetime
-import json
+from typing import Literal
+from pydantic import BaseModel
+import csv
+import io
 import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import time
+import logging
+import orjson
+import msgpack
+from functools import lru_cache, partial
+from diskcache import Cache
 
 # --- 1. SETUP & CONFIGURATION ---
-API_KEY = st.secrets["GEMINI_API_KEY"]
-client = genai.Client(api_key=API_KEY)
+@st.cache_resource
+def get_genai():
+    """One Gemini client (and connection pool) per process rather than per rerun."""
+    return genai.Client(api_key=st.secrets["GEMINI_API_KEY"])
+
+@st.cache_resource
+def get_event_loop():
+    """Long-lived loop so the cached client's async connection pool outlives each scan."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+@st.cache_resource
+def get_writer():
+    """Single thread that owns every DB and journal write, keeping blocking I/O off the shared loop."""
+    return ThreadPoolExecutor(1, thread_name_prefix="sentinel-writer")
+
+async def on_writer(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(get_writer(), partial(fn, *args))
+
+logger = logging.getLogger(__name__)
+
 DB_FILE = "sentinel_slr.db"
-CONFIG_FILE = "sentinel_config.json"
+CONFIG_FILE = "sentinel_config.mpk"  # msgpack snapshot record followed by appended stat deltas
+LEGACY_CONFIG_FILE = "sentinel_config.json"
+JOURNAL_COMPACT_EVERY = 1000
+CACHE_DIR = "./gemini_cache"
+MAX_CONCURRENCY = 10  # Gemini tier limit on parallel requests
+LOG_PAGE_SIZE = 200
+MAX_IMAGE_SIDE = 1280
+JPEG_QUALITY = 80
+
+@lru_cache(maxsize=4)
+def _replay_config(mtime_ns, size):
+    """Returns (config, delta count, byte offset where the last good record ends)."""
+    with open(CONFIG_FILE, 'rb') as f:
+        records = msgpack.Unpacker(f)
+        config = next(records)
+        deltas, end = 0, records.tell()
+        # A torn or garbled tail ends the replay instead of breaking every load
+        try:
+            for d in records:
+                rule, dwins, dlosses, dtotal_loss = d['r'], d['w'], d['l'], d['t']
+                stats = config['rule_stats'].get(rule, {"wins": 0, "losses": 0})
+                # Compute everything before assigning so a bad record changes nothing
+                updated = {"wins": stats['wins'] + dwins, "losses": stats['losses'] + dlosses}
+                total_losses = config['total_losses'] + dtotal_loss
+                config['rule_stats'][rule], config['total_losses'] = updated, total_losses
+                deltas, end = deltas + 1, records.tell()
+        except (msgpack.UnpackException, ValueError, KeyError, TypeError):
+            pass
+    return config, deltas, end
+
+def _replay_current():
+    stat = os.stat(CONFIG_FILE)
+    return _replay_config(stat.st_mtime_ns, stat.st_size)
 
 def load_config():
+    """Replays the snapshot + delta journal only when the file changes."""
+    if os.path.exists(CONFIG_FILE):
+        return _replay_current()[0]
+    if os.path.exists(LEGACY_CONFIG_FILE):
+        with open(LEGACY_CONFIG_FILE, 'rb') as f: return orjson.loads(f.read())
+    return {"version": 2.1, "total_losses": 0.0, "rule_stats": {
+        "Avoid chasing vertical moves.": {"wins": 0, "losses": 0},
+        "Check RSI for 70+ levels.": {"wins": 0, "losses": 0}
+    }}
+
+# End offset and delta count of the journal as this process last wrote it, so appends never re-read it
+_journal = {}
+
+def save_config(config):
+    """Writes a fresh snapshot (dropping the journal) and swaps it in atomically."""
+    tmp = CONFIG_FILE + ".tmp"
+    snapshot = msgpack.packb(config)
+    with open(tmp, 'wb') as f:
+        f.write(snapshot)
+        f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, CONFIG_FILE)
+    _journal.update(end=len(snapshot), deltas=0)
+    # Coarse filesystem mtimes can repeat within a tick, so don't trust the old entry
+    _replay_config.cache_clear()
+
+def _open_journal():
+    """Replays the journal once per process and cuts off any torn tail left by a crash."""
     if not os.path.exists(CONFIG_FILE):
-        return {"version": 2.1, "total_losses": 0.0, "rule_stats": {
-            "Avoid chasing vertical moves.": {"wins": 0, "losses": 0},
-            "Check RSI for 70+ levels.": {"wins": 0, "losses": 0}
-        }}
-    with open(CONFIG_FILE, 'r') as f: return json.load(f)
+        save_config(load_config())
+    if not _journal:
+        _, deltas, end = _replay_current()
+        with open(CONFIG_FILE, 'r+b') as f: f.truncate(end)
+        _journal.update(end=end, deltas=deltas)
+
+def append_delta(tally):
+    """Appends an audit's (rule, wins, losses, loss amount) rows with one write and one fsync."""
+    _open_journal()
+    now = time.time()
+    payload = b"".join(msgpack.packb({'r': rule, 'w': dwins, 'l': dlosses, 't': dtotal_loss, 'ts': now})
+                       for rule, dwins, dlosses, dtotal_loss in tally)
+    try:
+        with open(CONFIG_FILE, 'ab') as f:
+            f.write(payload)
+            f.flush(); os.fsync(f.fileno())
+    except BaseException:
+        # The tail may now be partial; the next append replays and truncates it
+        _journal.clear()
+        raise
+    _journal['end'] += len(payload)
+    _journal['deltas'] += len(tally)
+
+def compact_config():
+    """Folds the journal back into a single snapshot once it gets long."""
+    if _journal.get('deltas', 0) >= JOURNAL_COMPACT_EVERY:
+        save_config(load_config())
+
+@st.cache_resource
+def get_verdict_cache():
+    """Disk cache of parsed Gemini verdicts keyed by chart bytes + prompt."""
+    return Cache(CACHE_DIR)
+
+@st.cache_resource
+def get_conn():
+    """One shared WAL-mode write connection, only ever used from the writer thread."""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn.executescript("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; "
+                       "PRAGMA cache_size=-64000; PRAGMA mmap_size=268435456;")
+    return conn
+
+@st.cache_resource
+def get_read_conn():
+    """Read-only connection for the UI, so it never sees the writer's uncommitted rows."""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn.executescript("PRAGMA query_only=ON; PRAGMA temp_store=MEMORY; PRAGMA cache_size=-64000; PRAGMA mmap_size=268435456;")
+    return conn
 
 # --- 2. THE REINFORCEMENT LEARNING ENGINE ---
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute('''CREATE TABLE IF NOT EXISTS slr_log 
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME, 
-                 verdict_text TEXT, outcome TEXT, rule_applied TEXT,
-                 entry_price REAL, target_price REAL, stop_price REAL, 
-                 reflection_text TEXT)''')
-    conn.commit()
-    conn.close()
-
-def automated_audit(current_price):
-    """Closes previous trades automatically based on new data."""
-    conn = sqlite3.connect(DB_FILE)
-    pending = pd.read_sql_query("SELECT * FROM slr_log WHERE outcome IS NULL", conn)
-    config = load_config()
-    updated = False
-
-    for _, trade in pending.iterrows():
-        status = None
-        if current_price >= trade['target_price']:
-            status = 'Win ✅'
-            config['rule_stats'][trade['rule_applied']]['wins'] += 1
-            updated = True
-        elif current_price <= trade['stop_price']:
-            status = 'Loss ❌'
-            config['rule_stats'][trade['rule_applied']]['losses'] += 1
-            config['total_losses'] += abs(trade['entry_price'] - trade['stop_price'])
-            updated = True
-            p = f"CRITICAL: Financial loss at {current_price}. Diagnose the flaw."
-            res = client.models.generate_content(model="gemini-2.0-flash", contents=[p])
-            conn.execute("UPDATE slr_log SET reflection_text = ? WHERE id = ?", (res.text, trade['id']))
-
-        if status:
-            conn.execute("UPDATE slr_log SET outcome = ? WHERE id = ?", (status, trade['id']))
-    
-    conn.commit()
-    conn.close()
-    if updated:
-        with open(CONFIG_FILE, 'w') as f: json.dump(config, f)
+    # idx_outcome turns the audit's "outcome IS NULL" lookup into an index seek;
+    # ORDER BY id DESC already walks the rowid, so it needs no index of its own.
+    get_conn().executescript('''CREATE TABLE IF NOT EXISTS slr_log 
+                     (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME, 
+                     verdict_text TEXT, outcome TEXT, rule_applied TEXT,
+                     entry_price REAL, target_price REAL, stop_price REAL, 
+                     reflection_text TEXT);
+                     CREATE INDEX IF NOT EXISTS idx_outcome ON slr_log(outcome);''')
+
+def store_reflection(trade_id, text):
+    with get_conn() as conn:
+        conn.execute("UPDATE slr_log SET reflection_text = ? WHERE id = ?", (text, trade_id))
+
+async def reflect(trade_id, current_price, sem):
+    p = f"CRITICAL: Financial loss at {current_price}. Diagnose the flaw."
+    async with sem:
+        res = await client.aio.models.generate_content(model="gemini-2.0-flash", contents=[p])
+    await on_writer(store_reflection, trade_id, res.text)
+
+def close_trades(current_price):
+    """Closes previous trades automatically based on new data; returns the ids that closed as losses."""
+    conn = get_conn()
+    # A pending trade closes as a Win if the target is hit, otherwise as a Loss if the stop is hit
+    won = ":price >= target_price"
+    hit = f"outcome IS NULL AND ({won} OR :price <= stop_price)"
+    params = {"price": current_price}
+    tally = conn.execute(f"""SELECT rule_applied, SUM({won}), SUM(NOT ({won})),
+                             SUM(CASE WHEN {won} THEN 0 ELSE ABS(entry_price - stop_price) END)
+                             FROM slr_log WHERE {hit} GROUP BY rule_applied""", params).fetchall()
+    if not tally:
+        return []
+    losers = [trade_id for (trade_id,) in conn.execute(f"SELECT id FROM slr_log WHERE {hit} AND NOT ({won})", params)]
+
+    with conn:
+        conn.execute(f"UPDATE slr_log SET outcome = CASE WHEN {won} THEN 'Win ✅' ELSE 'Loss ❌' END WHERE {hit}", params)
+
+    append_delta(tally)
+    compact_config()
+    return losers
+
+@st.cache_resource
+def get_background_reflections():
+    """Strong references to in-flight reflections, since the loop only keeps weak ones; outlives reruns."""
+    return set()
+
+def _reflection_done(task):
+    get_background_reflections().discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Loss reflection failed", exc_info=task.exception())
+
+async def automated_audit(current_price, sem):
+    """Runs close_trades on the writer thread; loss reflections finish in the background."""
+    # The single writer thread runs audits one at a time, so concurrent charts cannot interleave them
+    for trade_id in await on_writer(close_trades, current_price):
+        task = asyncio.create_task(reflect(trade_id, current_price, sem))
+        get_background_reflections().add(task)
+        task.add_done_callback(_reflection_done)
+
+@lru_cache(maxsize=16)
+def _best_rule(stats):
+    scores = {rule: (w + 1) / (w + l + 1) for rule, w, l in stats}
+    return max(scores, key=scores.get)
+
+def pick_best_rule(rule_stats):
+    """Highest Laplace-smoothed win rate, recomputed only when the stats change."""
+    return _best_rule(tuple((k, v['wins'], v['losses']) for k, v in rule_stats.items()))
 
 # --- 3. ANALYST WITH STABILITY PATCHES ---
-def process_chart(img_file, best_rule, loss_streak):
-    raw_img = Image.open(img_file)
-    processed_img = ImageEnhance.Contrast(raw_img).enhance(1.8)
-    
+class Verdict(BaseModel):
+    """Schema Gemini is forced to answer in, so replies always parse."""
+    verdict: Literal["BUY", "SELL", "WAIT"]
+    price: float
+    target: float
+    stop: float
+    confidence: int
+    logic: str
+
+VERDICT_CONFIG = types.GenerateContentConfig(response_mime_type="application/json", response_schema=Verdict)
+
+def prepare_chart(raw):
+    """Contrast-boosts the chart, then shrinks and encodes it as a greyscale JPEG to cut upload size."""
+    # Charts carry their signal in shape and text, not hue, so decode straight to one 8-bit channel
+    grey = cv2.imdecode(np.frombuffer(raw, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if grey is None:
+        raise ValueError("Could not decode chart image")
+    # Shrink first: INTER_AREA preserves the mean, so the stretch below only touches <= MAX_IMAGE_SIDE px
+    scale = MAX_IMAGE_SIDE / max(grey.shape[:2])
+    if scale < 1:
+        grey = cv2.resize(grey, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    # Same 256-entry table PIL's Contrast(1.8) builds: stretch around the mean grey level, saturating at 0 and 255
+    lut = np.clip(np.arange(256) * 1.8 - 0.8 * grey.mean(), 0, 255).astype(np.uint8)
+    processed = cv2.LUT(grey, lut)
+    ok, jpeg = cv2.imencode(".jpg", processed, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+    if not ok:
+        raise ValueError("Could not encode chart image")
+    return types.Part.from_bytes(data=jpeg.tobytes(), mime_type="image/jpeg")
+
+async def process_chart_async(img_file, best_rule, loss_streak, sem):
     effort = "Deep technical scan. Risk is HIGH." if loss_streak > 0 else "Standard scan."
-    prompt = f"{effort} Rule: {best_rule}. Extract PRICE. Return ONLY JSON: {{'verdict': 'BUY/SELL', 'price': float, 'target': float, 'stop': float, 'logic': 'str'}}"
+    prompt = f"{effort} Rule: {best_rule}. Extract PRICE, then give target, stop, confidence (0-100) and your logic."
     
-    try:
-        response = client.models.generate_content(model="gemini-2.0-flash", contents=[prompt, processed_img])
-        
-        # STABILITY PATCH: Clean AI response for JSON parsing
-        clean_text = response.text.replace("```json", "").replace("```", "").strip()
-        data = json.loads(clean_text)
-        
-        automated_audit(data['price'])
-        
-        conn = sqlite3.connect(DB_FILE)
-        conn.execute("INSERT INTO slr_log (timestamp, verdict_text, rule_applied, entry_price, target_price, stop_price) VALUES (?, ?, ?, ?, ?, ?)",
-                     (datetime.now().strftime("%Y-%m-%d %H:%M"), data['logic'], best_rule, data['price'], data['target'], data['stop']))
-        conn.commit(); conn.close()
-        return data
-    except Exception as e:
-        st.error(f"⚠️ Sentinel Brain Error: {str(e)}")
-        return None
+    # The prompt already carries the rule and effort level, so it keys the cache alongside the image
+    cache = get_verdict_cache()
+    raw = img_file.getvalue()
+    key = hashlib.sha256(raw + prompt.encode()).hexdigest()
+    
+    # Decoding and disk-cache I/O block, so keep them off the loop every session shares;
+    # cv2 releases the GIL, so charts decode in parallel
+    data = await asyncio.to_thread(cache.get, key)
+    if data is None:
+        chart = await asyncio.to_thread(prepare_chart, raw)
+        async with sem:
+            response = await client.aio.models.generate_content(model="gemini-2.0-flash", contents=[prompt, chart], config=VERDICT_CONFIG)
+        data = Verdict.model_validate_json(response.text).model_dump()
+        await asyncio.to_thread(cache.set, key, data)
+    
+    # A WAIT is not a trade, so it must not be logged as a pending one for later audits to close
+    row = None if data['verdict'] == "WAIT" else (datetime.now().strftime("%Y-%m-%d %H:%M"), data['logic'], best_rule, data['price'], data['target'], data['stop'])
+    # The chart's price is still real market data, so it closes existing trades either way
+    await automated_audit(data['price'], sem)
+    return data, row
+
+def log_verdicts(rows):
+    """Logs every new verdict in one transaction rather than one commit per chart."""
+    with get_conn() as conn:
+        conn.executemany("INSERT INTO slr_log (timestamp, verdict_text, rule_applied, entry_price, target_price, stop_price) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+async def scan_charts(files, best_rule, loss_streak):
+    """Fans out every uploaded chart to Gemini at once, capped at MAX_CONCURRENCY.
+
+    Runs on the background loop, so chart failures are returned for the script thread to show.
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    outcomes = await asyncio.gather(*[process_chart_async(f, best_rule, loss_streak, sem) for f in files], return_exceptions=True)
+    results = [o for o in outcomes if not isinstance(o, Exception)]
+    errors = [o for o in outcomes if isinstance(o, Exception)]
+    await on_writer(log_verdicts, [row for _, row in results if row])
+    return [data for data, _ in results], errors
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def load_log_page(page, version):
+    """One page of the audit log; `version` is only the cache key and changes on every write."""
+    return pd.read_sql_query("SELECT * FROM slr_log ORDER BY id DESC LIMIT ? OFFSET ?", get_read_conn(),
+                             params=(LOG_PAGE_SIZE, page * LOG_PAGE_SIZE))
+
+def export_log_csv():
+    """Builds the whole audit log as CSV in memory, newest first."""
+    cur = get_read_conn().execute("SELECT * FROM slr_log ORDER BY id DESC")
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([d[0] for d in cur.description])
+    writer.writerows(cur)
+    return buf.getvalue()
+
+@st.cache_resource
+def warm_start():
+    """Builds the Gemini client, DB schema and config cache side by side, once per process."""
+    fut_db = get_writer().submit(init_db)
+    with ThreadPoolExecutor(2) as ex:
+        fut_client, fut_cfg = ex.submit(get_genai), ex.submit(load_config)
+        fut_db.result(); fut_cfg.result()
+        return fut_client.result()
 
 # --- 4. UI LAYOUT ---
 st.set_page_config(page_title="🛡️ Sentinel SLR", layout="wide")
-init_db()
+client = warm_start()
 
 with st.sidebar:
     st.header("⚖️ Risk Monitor")
     config = load_config()
     st.metric("Risk Impact", f"${config['total_losses']:.2f}")
-    if os.path.exists(DB_FILE):
-        with open(DB_FILE, "rb") as f:
-            st.download_button("📥 Backup DB", f, "sentinel.db")
+    # Snapshot only on request; serialize() reads committed pages through the WAL, so no checkpoint is needed
+    if st.button("🗄️ Prepare Backup"):
+        st.download_button("📥 Backup DB", get_read_conn().serialize(), "sentinel.db")
 
 st.title("🛡️ Sentinel Autonomous Intelligence")
 tab1, tab2 = st.tabs(["📸 Scanner", "📊 Audit Log"])
@@ -106,10 +343,16 @@ tab1, tab2 = st.tabs(["📸 Scanner", "📊 Audit Log"])
 with tab1:
     files = st.file_uploader("Upload Charts", type=["jpg","png","jpeg"], accept_multiple_files=True)
     if files and st.button("🚀 Run Auto-Audit & Predict"):
-        best_rule = max(config['rule_stats'], key=lambda x: (config['rule_stats'][x]['wins']+1)/(config['rule_stats'][x]['wins']+config['rule_stats'][x]['losses']+1))
-        for f in files:
-            res = process_chart(f, best_rule, config['total_losses'])
-            if res: st.success(f"Verified {res['verdict']} at {res['price']}")
+        best_rule = pick_best_rule(config['rule_stats'])
+        verdicts, errors = run_async(scan_charts(files, best_rule, config['total_losses']))
+        for e in errors:
+            st.error(f"⚠️ Sentinel Brain Error: {str(e)}")
+        for res in verdicts:
+            st.success(f"Verified {res['verdict']} at {res['price']}")
 
 with tab2:
-    st.dataframe(pd.read_sql_query("SELECT * FROM slr_log ORDER BY id DESC", sqlite3.connect(DB_FILE)))
+    page = st.number_input("Page", min_value=0, step=1)
+    # data_version changes whenever the writer commits, so it invalidates the cache
+    st.dataframe(load_log_page(page, get_read_conn().execute("PRAGMA data_version").fetchone()[0]))
+    if st.button("🧾 Prepare CSV Export"):
+        st.download_button("📥 Download Log CSV", export_log_csv(), "sentinel_log.csv", "text/csv")